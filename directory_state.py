@@ -0,0 +1,357 @@
+import os
+import time
+import sqlite3
+import threading
+from watchdog.observers import Observer
+from watchdog.events import (
+    FileSystemEventHandler,
+    FileCreatedEvent, FileModifiedEvent, FileDeletedEvent,
+    DirCreatedEvent, DirDeletedEvent,
+)
+
+# ========== CONFIGURATION ==========
+
+RESCAN_INTERVAL = 600        # Safety-net rescan while the watcher is healthy (s)
+FALLBACK_RESCAN_INTERVAL = 30  # Rescan period when running without a watcher (s)
+HEALTH_CHECK_INTERVAL = 5    # Watcher health / overflow check period (s)
+WATCH_BUDGET_SHARE = 0.5     # Share of the inotify watch limit we allow ourselves
+COMMIT_EVERY = 1000          # Index rows written per transaction during a rescan
+
+SCHEMA_VERSION = 1           # Bump to rebuild existing index databases
+
+INOTIFY_MAX_WATCHES = "/proc/sys/fs/inotify/max_user_watches"
+
+def inotify_watch_budget():
+    """
+    Number of inotify watches we may use, or None when not on inotify.
+    A recursive watch costs one watch per directory and the kernel limit is
+    shared by every process of the user, so only a share of it is taken.
+    """
+    try:
+        with open(INOTIFY_MAX_WATCHES) as f:
+            return int(int(f.read().strip()) * WATCH_BUDGET_SHARE)
+    except (OSError, ValueError):
+        return None
+
+overflow_listeners = []  # Called from the inotify thread on IN_Q_OVERFLOW
+
+def hook_inotify_overflow():
+    """
+    Watchdog drops the kernel's IN_Q_OVERFLOW event (wd == -1) without
+    telling anyone, so wrap its event buffer parser to notice it. Returns
+    False where inotify isn't available or watchdog's internals differ.
+    """
+    try:
+        from watchdog.observers.inotify_c import Inotify, InotifyConstants
+        parse = Inotify._parse_event_buffer
+    except (ImportError, AttributeError):
+        return False
+    if getattr(parse, "overflow_hooked", False):
+        return True
+
+    def parse_event_buffer(event_buffer):
+        for wd, mask, cookie, name in parse(event_buffer):
+            if wd == -1 and mask & InotifyConstants.IN_Q_OVERFLOW:
+                for listener in list(overflow_listeners):
+                    listener()
+            yield wd, mask, cookie, name
+
+    parse_event_buffer.overflow_hooked = True
+    Inotify._parse_event_buffer = staticmethod(parse_event_buffer)
+    return True
+
+# ========== PERSISTED INDEX ==========
+
+class DirectoryIndex:
+    """
+    Stat data (mtime, size, type) of every entry under `root`, kept in SQLite
+    so a rescan only reports what changed and memory stays bounded by the
+    size of a single directory rather than the whole tree. Paths are stored
+    as raw bytes (BLOBs) so names that aren't valid UTF-8 can be indexed.
+    """
+    def __init__(self, db_path, root, log=print):
+        self.root = root
+        self.log = log
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Older indexes stored paths as TEXT; rebuild from scratch
+            self.db.execute("DROP TABLE IF EXISTS entries")
+            self.db.execute("DROP TABLE IF EXISTS meta")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " path BLOB PRIMARY KEY, parent BLOB NOT NULL,"
+            " mtime_ns INTEGER, size INTEGER, is_dir INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def _rel(self, path):
+        return os.fsencode(os.path.relpath(path, self.root))
+
+    def _path(self, rel):
+        return os.path.join(self.root, os.fsdecode(rel))
+
+    @staticmethod
+    def _signature(st, is_dir):
+        # Directory sizes are filesystem noise; mtime alone tracks them
+        return (st.st_mtime_ns, 0 if is_dir else st.st_size, int(is_dir))
+
+    def _put(self, rel, signature):
+        try:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (rel, os.path.dirname(rel) or b".", *signature),
+            )
+        except (ValueError, sqlite3.Error) as e:
+            self.log(f"[Watch] Could not index {self._path(rel)!r}: {e}")
+            return False
+        return True
+
+    def _forget(self, rel):
+        if rel == b".":
+            self.db.execute("DELETE FROM entries")
+            return
+        # Range query over the primary key: every "rel/..." sorts between
+        # "rel/" and "rel" followed by the byte after the separator
+        sep = os.fsencode(os.sep)
+        self.db.execute(
+            "DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+            (rel, rel + sep, rel + bytes([sep[0] + 1])),
+        )
+
+    @property
+    def seeded(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'seeded'").fetchone()
+        return row is not None
+
+    def directory_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries WHERE is_dir = 1").fetchone()[0]
+
+    def update(self, path):
+        """Re-stats a single path, e.g. after a watcher event or a sync write."""
+        rel = self._rel(path)
+        if rel == b".":
+            return
+        with self.lock:
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                self._forget(rel)
+            else:
+                self._put(rel, self._signature(st, os.path.isdir(path) and not os.path.islink(path)))
+            self.db.commit()
+
+    def update_tree(self, path):
+        """Like update(), but also indexes everything below a directory silently."""
+        self.update(path)
+        stack = [path] if os.path.isdir(path) else []
+        while stack:
+            _, subdirs, _ = self._scan_directory(stack.pop(), seeding=True)
+            stack.extend(subdirs)
+        with self.lock:
+            self.db.commit()
+
+    def forget(self, path):
+        """Drops a path and everything below it."""
+        with self.lock:
+            self._forget(self._rel(path))
+            self.db.commit()
+
+    def _scan_directory(self, directory, seeding):
+        events, subdirs = [], []
+        parent = self._rel(directory)
+        with self.lock:
+            known = {
+                row[0]: tuple(row[1:])
+                for row in self.db.execute(
+                    "SELECT path, mtime_ns, size, is_dir FROM entries WHERE parent = ?", (parent,)
+                )
+            }
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                # Vanished mid-scan; the parent's pass reports the deletion
+                return events, subdirs, 0
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    signature = self._signature(entry.stat(follow_symlinks=False), is_dir)
+                except OSError:
+                    continue
+                rel = self._rel(entry.path)
+                old = known.pop(rel, None)
+                if is_dir:
+                    subdirs.append(entry.path)
+                if old == signature:
+                    continue
+                if old is not None and old[2] != signature[2]:
+                    # Replaced by an entry of the other type
+                    self._forget(rel)
+                    events.append((DirDeletedEvent if old[2] else FileDeletedEvent)(entry.path))
+                    old = None
+                if not self._put(rel, signature):
+                    continue
+                if old is None:
+                    events.append((DirCreatedEvent if is_dir else FileCreatedEvent)(entry.path))
+                elif not is_dir:
+                    events.append(FileModifiedEvent(entry.path))
+            for rel, old in known.items():
+                self._forget(rel)
+                path = self._path(rel)
+                events.append((DirDeletedEvent if old[2] else FileDeletedEvent)(path))
+        return ([] if seeding else events), subdirs, len(events)
+
+    def rescan(self, dispatch):
+        """
+        Walks the tree comparing stat data with the index and passes a
+        watchdog event for every difference to `dispatch`. The first scan only
+        seeds the index. Returns the number of changes found.
+        """
+        seeding = not self.seeded
+        changes = written = 0
+        stack = [self.root]
+        while stack:
+            events, subdirs, count = self._scan_directory(stack.pop(), seeding)
+            stack.extend(subdirs)
+            changes += count
+            written += count
+            if written >= COMMIT_EVERY:
+                with self.lock:
+                    self.db.commit()
+                written = 0
+            # Handlers may read file contents, so never dispatch under the lock
+            for event in events:
+                dispatch(event)
+        with self.lock:
+            if seeding:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', '1')")
+            self.db.commit()
+        return 0 if seeding else changes
+
+class IndexUpdater(FileSystemEventHandler):
+    """Keeps the index in step with watcher events so rescans don't repeat them."""
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed", "closed_no_write"):
+            return
+        self.index.update(event.src_path)
+        if getattr(event, "dest_path", ""):
+            self.index.update(event.dest_path)
+
+# ========== WATCH SUPERVISOR ==========
+
+class WatchSupervisor(threading.Thread):
+    """
+    Runs the watchdog observer for `root` and backs it with periodic rescans.
+    The observer is started off the main thread so large trees don't delay
+    startup, is skipped when the tree needs more inotify watches than the
+    budget allows or when the kernel refuses them, and is dropped in favour
+    of rescans if its threads die. An inotify queue overflow or a dead
+    watcher triggers a rescan within HEALTH_CHECK_INTERVAL seconds.
+    Pass `rescanned` when the caller has just rescanned the tree itself, so
+    startup doesn't walk it twice.
+    """
+    def __init__(self, handler, root, index, log=print, rescanned=False):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.root = root
+        self.index = index
+        self.log = log
+        self.rescanned = rescanned
+        self.observer = None
+        self.stopped = threading.Event()
+        self.rescan_requested = threading.Event()
+
+    def _start_observer(self):
+        budget = inotify_watch_budget()
+        if budget is not None and self.index.directory_count() > budget:
+            self.log(f"[Watch] Tree needs more than {budget} inotify watches. Using rescans only.")
+            return
+        if hook_inotify_overflow():
+            overflow_listeners.append(self._on_overflow)
+        observer = Observer()
+        watch = observer.schedule(self.handler, path=self.root, recursive=True)
+        observer.add_handler_for_watch(IndexUpdater(self.index), watch)
+        try:
+            observer.start()
+        except OSError as e:
+            self.log(f"[Watch] Could not start watcher ({e}). Using rescans only.")
+            return
+        self.observer = observer
+
+    def _on_overflow(self):
+        self.log("[Watch] Event queue overflowed. Rescanning.")
+        self.rescan_requested.set()
+
+    def _observer_healthy(self):
+        if not self.observer.is_alive():
+            return False
+        for emitter in self.observer.emitters:
+            if not emitter.is_alive():
+                return False
+            # The inotify emitter reads through a buffer thread that dies on
+            # errors such as ENOSPC when a new subdirectory can't be watched
+            buffer = getattr(emitter, "_inotify", None)
+            if isinstance(buffer, threading.Thread) and not buffer.is_alive():
+                return False
+        return True
+
+    def rescan(self):
+        """Runs one rescan; errors are logged so the supervisor keeps going."""
+        try:
+            changes = self.index.rescan(self.handler.dispatch)
+        except Exception as e:
+            self.log(f"[Watch] Rescan failed: {e}")
+            return False
+        if changes:
+            self.log(f"[Watch] Rescan found {changes} unreported change(s)")
+        return True
+
+    def run(self):
+        if not self.index.seeded:
+            self.log("[Watch] Building directory index...")
+            self.rescan()
+        try:
+            self._start_observer()
+        except Exception as e:
+            self.log(f"[Watch] Could not start watcher ({e}). Using rescans only.")
+        # Picks up changes made while we were offline or registering watches
+        ok = self.rescanned or self.rescan()
+        next_rescan = time.monotonic() + (RESCAN_INTERVAL if self.observer and ok else FALLBACK_RESCAN_INTERVAL)
+        while not self.stopped.wait(HEALTH_CHECK_INTERVAL):
+            try:
+                if self.observer and not self._observer_healthy():
+                    self.log("[Watch] Watcher stopped delivering events. Using rescans only.")
+                    self.observer.stop()
+                    self.observer = None
+                    self.rescan_requested.set()
+            except Exception as e:
+                self.log(f"[Watch] Health check failed: {e}")
+            if self.rescan_requested.is_set() or time.monotonic() >= next_rescan:
+                self.rescan_requested.clear()
+                ok = self.rescan()
+                # Retry a failed rescan sooner than the safety-net interval
+                interval = RESCAN_INTERVAL if self.observer and ok else FALLBACK_RESCAN_INTERVAL
+                next_rescan = time.monotonic() + interval
+
+    def stop(self):
+        self.stopped.set()
+        if self._on_overflow in overflow_listeners:
+            overflow_listeners.remove(self._on_overflow)
+        if self.observer:
+            self.observer.stop()
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self.observer:
+            self.observer.join(timeout)
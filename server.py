@@ -8,15 +8,16 @@ import base64
 import threading
 import requests
 from flask import Flask, request, jsonify
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
+from directory_state import DirectoryIndex, WatchSupervisor
 
 # ========== CONFIGURATION ==========
 
 WORKING_DIR = os.getcwd()
 WATCH_PATH = os.path.join(WORKING_DIR, "test_chamber")
 CHANGE_LOG = os.path.join(WORKING_DIR, "change_log.json")
+INDEX_DB = os.path.join(WORKING_DIR, ".server_index.db")  # Stat index for rescans
 
 # Peer machine's IP address
 PEER_ADDRESS = "http://"
@@ -25,6 +26,8 @@ MACHINE_ID = socket.gethostname()
 
 log_lock = threading.Lock()  # Ensures thread-safe access
 
+directory_index = None  # DirectoryIndex, opened at startup
+
 # ========== INIT SETUP ==========
 
 if not os.path.exists(CHANGE_LOG):
@@ -74,6 +77,8 @@ class SyncHandler(FileSystemEventHandler):
     def __init__(self):
         super().__init__()
         self.last_events = {}
+        # Rescans dispatch from the supervisor thread as well as the observer's
+        self.lock = threading.Lock()
 
     def _read_file_content(self, path):
         if not os.path.exists(path):
@@ -92,11 +97,17 @@ class SyncHandler(FileSystemEventHandler):
         if rel_src == os.path.basename(CHANGE_LOG):
             return
 
-        now = datetime.now().timestamp()
         key = (event_type, rel_src, rel_dest)
-        if now - self.last_events.get(key, 0) < 0.5:
-            return
-        self.last_events[key] = now
+        with self.lock:
+            now = datetime.now().timestamp()
+            if now - self.last_events.get(key, 0) < 0.5:
+                return
+            # Re-insert so keys stay in timestamp order and expired ones can be
+            # popped off the front, keeping the table bounded on large trees
+            self.last_events.pop(key, None)
+            self.last_events[key] = now
+            while now - next(iter(self.last_events.values())) >= 0.5:
+                del self.last_events[next(iter(self.last_events))]
 
         change = {
             'timestamp': datetime.now().isoformat(),
@@ -146,6 +157,7 @@ def apply_changes(changes):
                     os.makedirs(src_path, exist_ok=True)
                 else:
                     write_file_content(src_path, change.get('content', ''))
+                directory_index.update(src_path)
 
             elif change['type'] == 'deleted':
                 if os.path.exists(src_path):
@@ -153,15 +165,19 @@ def apply_changes(changes):
                         shutil.rmtree(src_path)
                     else:
                         os.remove(src_path)
+                directory_index.forget(src_path)
 
             elif change['type'] == 'moved':
                 if os.path.exists(src_path):
                     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
                     shutil.move(src_path, dest_path)
+                    directory_index.forget(src_path)
+                    directory_index.update_tree(dest_path)
 
             elif change['type'] == 'modified':
                 if not change['is_directory']:
                     write_file_content(src_path, change.get('content', ''))
+                    directory_index.update(src_path)
 
         except Exception as e:
             print(f"Error applying {change['type']} {change['src']}: {e}")
@@ -182,6 +198,7 @@ def initial_sync_from_peer():
 
             if item['is_directory']:
                 os.makedirs(local_path, exist_ok=True)
+                directory_index.update(local_path)
                 continue
 
             remote_mtime = item.get('last_modified')
@@ -191,6 +208,7 @@ def initial_sync_from_peer():
                 print(f"[Init Sync] Creating missing file: {item['path']}")
                 write_file_content(local_path, remote_content)
                 os.utime(local_path, (remote_mtime, remote_mtime))
+                directory_index.update(local_path)
                 continue
 
             local_mtime = os.path.getmtime(local_path)
@@ -201,6 +219,7 @@ def initial_sync_from_peer():
                 print(f"[Conflict] Remote file newer: Replacing {item['path']}")
                 write_file_content(local_path, remote_content)
                 os.utime(local_path, (remote_mtime, remote_mtime))
+                directory_index.update(local_path)
             else:
                 print(f"[Conflict] Local file newer: Keeping {item['path']}")
 
@@ -299,6 +318,7 @@ def printConfiguration():
     print(f" Working directory: {WORKING_DIR}")
     print(f" Watch path: {WATCH_PATH}")
     print(f" Change log file: {CHANGE_LOG}")
+    print(f" Index file: {INDEX_DB}")
     print(f" Machine ID: {MACHINE_ID}")
     print("---\n")
 
@@ -308,14 +328,15 @@ if __name__ == "__main__":
     printConfiguration()
 
     os.makedirs(WATCH_PATH, exist_ok=True)
+    directory_index = DirectoryIndex(INDEX_DB, WATCH_PATH)
 
     print("Performing initial synchronization with peer...")
     initial_sync_from_peer()
 
     print(f"Starting sync on {MACHINE_ID}")
-    observer = Observer()
-    observer.schedule(SyncHandler(), path=WATCH_PATH, recursive=True)
-    observer.start()
+    # Watches are registered in the background; rescans cover what they miss
+    watcher = WatchSupervisor(SyncHandler(), WATCH_PATH, directory_index)
+    watcher.start()
 
     threading.Thread(target=run_server, daemon=True).start()
     threading.Thread(target=sync_with_peer, daemon=True).start()
@@ -325,7 +346,7 @@ if __name__ == "__main__":
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
+        watcher.stop()
         print("Stopping sync...")
 
-    observer.join()
\ No newline at end of file
+    watcher.join()
\ No newline at end of file
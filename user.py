@@ -5,14 +5,16 @@ import json
 import shutil
 import socket
 import base64
+import hashlib
 import threading
 import requests
 import webbrowser
 from flask import Flask, request, jsonify, render_template
 from flask_socketio import SocketIO
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
+from collections import OrderedDict
+from directory_state import DirectoryIndex, WatchSupervisor
 
 # ========== CONFIGURATION ==========
 
@@ -24,20 +26,198 @@ WORKING_DIR = os.getcwd()
 WATCH_PATH = os.path.join(WORKING_DIR, "test_chamber")
 CHANGE_LOG = os.path.join(WORKING_DIR, "change_log.json")
 
+# Offline queue: change metadata goes to an append-only journal, file contents
+# to content-addressed blobs, so unpushed work survives a client restart.
+PENDING_DIR = os.path.join(WORKING_DIR, ".pending")
+BLOB_CACHE_BYTES = 32 * 1024 * 1024  # Max blob content kept in memory
+INDEX_DB = os.path.join(WORKING_DIR, ".user_index.db")  # Stat index for rescans
+SYNC_ECHO_TTL = 60  # Seconds watcher events of a sync write are recognized for
+
 MACHINE_ID = f"user-{socket.gethostname()}"
 
+# ========== LOGGING ==========
+
+def log(msg):
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
+
+# ========== PENDING QUEUE ==========
+
+class PendingQueue:
+    """
+    Disk-backed queue of local changes waiting to be pushed.
+    Entries only hold metadata and a blob hash; contents are read back from
+    disk on push, with the most recent blobs kept in a bounded memory cache.
+    """
+    def __init__(self, directory, cache_bytes):
+        self.journal = os.path.join(directory, "journal.jsonl")
+        self.blobs = os.path.join(directory, "blobs")
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_size = 0
+        self.entries = []
+        self.lock = threading.Lock()
+        os.makedirs(self.blobs, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.journal):
+            with open(self.journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A crash mid-append leaves a truncated last line
+                        log(f"Skipping corrupt journal line in {self.journal}")
+        if self.entries:
+            log(f"Restored {len(self.entries)} pending change(s) from disk")
+        # A crash between storing a blob and journaling its entry leaves
+        # temp files and orphan blobs behind
+        live = {e["blob"] for e in self.entries if "blob" in e}
+        for name in os.listdir(self.blobs):
+            if name not in live:
+                os.remove(os.path.join(self.blobs, name))
+
+    def _rewrite(self):
+        tmp = self.journal + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal)
+
+    def _copy_blob(self, path):
+        """
+        Streams `path` into a temp file while hashing it, so large files are
+        never held in memory in full. Returns (temp path, hash) or None.
+        """
+        digest = hashlib.sha256()
+        tmp = os.path.join(self.blobs, f".tmp-{threading.get_ident()}")
+        try:
+            with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+        except Exception as e:
+            log(f"Error reading {path}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        return tmp, digest.hexdigest()
+
+    def _cache_put(self, blob, content):
+        if blob in self.cache or len(content) > self.cache_bytes:
+            return
+        self.cache[blob] = content
+        self.cached_size += len(content)
+        while self.cached_size > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_size -= len(evicted)
+
+    def _cache_drop(self, blob):
+        content = self.cache.pop(blob, None)
+        if content is not None:
+            self.cached_size -= len(content)
+
+    def load_content(self, blob):
+        with self.lock:
+            if blob in self.cache:
+                self.cache.move_to_end(blob)
+                return self.cache[blob]
+        content = read_file_content(os.path.join(self.blobs, blob))
+        if content is not None:
+            with self.lock:
+                self._cache_put(blob, content)
+        return content
+
+    def append(self, change, path=None):
+        """Journals a change; if `path` is given its content is stored as a blob."""
+        copied = self._copy_blob(path) if path else None
+        with self.lock:
+            if copied:
+                # Publish the blob and reference it in one step, so a
+                # concurrent discard()/compact() can't collect it in between
+                tmp, blob = copied
+                os.replace(tmp, os.path.join(self.blobs, blob))
+                change["blob"] = blob
+            self.entries.append(change)
+            with open(self.journal, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(change) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.entries)
+
+    def discard(self, count):
+        """Removes the first `count` entries and deletes blobs nobody references."""
+        with self.lock:
+            dropped = self.entries[:count]
+            self.entries = self.entries[count:]
+            self._rewrite()
+            self._collect_blobs(dropped)
+
+    def _collect_blobs(self, dropped):
+        live = {e["blob"] for e in self.entries if "blob" in e}
+        for blob in {e["blob"] for e in dropped if "blob" in e} - live:
+            self._cache_drop(blob)
+            try:
+                os.remove(os.path.join(self.blobs, blob))
+            except FileNotFoundError:
+                pass
+
+    def compact(self):
+        """
+        Drops created/modified entries superseded by a later write to the same
+        path, so only the latest content of each file is pushed. A delete or
+        move touching the path in between keeps both writes.
+        """
+        with self.lock:
+            last_write = {}  # src -> index of its latest write since a barrier
+            superseded = set()
+            for i, e in enumerate(self.entries):
+                if e["type"] in ("created", "modified") and not e["is_directory"]:
+                    prev = last_write.get(e["src"])
+                    if prev is not None:
+                        superseded.add(prev)
+                        # Keep "created" so the server still sees the file being created
+                        if self.entries[prev]["type"] == "created":
+                            e["type"] = "created"
+                    last_write[e["src"]] = i
+                elif e["type"] in ("deleted", "moved"):
+                    # A delete/move is a barrier for the path and, for
+                    # directories, everything below it
+                    for path in (e["src"], e.get("dest")):
+                        if not path:
+                            continue
+                        for src in [k for k in last_write if k == path or k.startswith(path + os.sep)]:
+                            del last_write[src]
+            if superseded:
+                dropped = [self.entries[i] for i in superseded]
+                self.entries = [e for i, e in enumerate(self.entries) if i not in superseded]
+                self._rewrite()
+                self._collect_blobs(dropped)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
 # ========== STATE ==========
 
-pending_changes = []
+pending_changes = None  # PendingQueue, opened in start()
+directory_index = None  # DirectoryIndex, opened in start()
+push_lock = threading.Lock()  # One push at a time: discard() drops by position
+
+# Paths written by the sync engine -> (expected state, expiry), so the
+# watcher events they cause aren't journaled as local edits
+sync_writes = {}
+sync_writes_lock = threading.Lock()
+SYNC_PENDING = object()  # Write in progress: any event is an echo
 current_peer = None
 app = Flask(__name__, static_url_path='/static', static_folder='static', template_folder='templates')
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-# ========== LOGGING ==========
-
-def log(msg):
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-
 # ========== FILE I/O ==========
 
 def write_file_content(path, content_b64):
@@ -95,29 +275,132 @@ def get_fastest_peer():
     return None, []
 
 
+def path_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return "dir"
+    return (st.st_mtime_ns, st.st_size)
+
+def mark_sync_write(paths, pending=False):
+    """
+    Records `paths` as written by the sync engine. Call with `pending`
+    before writing and without it afterwards to capture the final state.
+    """
+    deadline = time.monotonic() + SYNC_ECHO_TTL
+    with sync_writes_lock:
+        for path in paths:
+            # Re-insert so entries stay in expiry order
+            sync_writes.pop(path, None)
+            sync_writes[path] = (SYNC_PENDING if pending else path_state(path), deadline)
+
+def is_sync_echo(path):
+    """True if a watcher event on `path` was caused by the sync engine."""
+    now = time.monotonic()
+    with sync_writes_lock:
+        while sync_writes and next(iter(sync_writes.values()))[1] < now:
+            del sync_writes[next(iter(sync_writes))]
+        expected = sync_writes.get(path)
+        if expected is None:
+            return False
+        if expected[0] is SYNC_PENDING or expected[0] == path_state(path):
+            return True
+        # Changed since we wrote it: a real local edit
+        del sync_writes[path]
+        return False
+
 def apply_remote_state(data):
     if data:
         for item in data:
             path = os.path.join(WORKING_DIR, item['path'])
+            written = [path, os.path.dirname(path)]
+            mark_sync_write(written, pending=True)
 
             if item['is_directory']:
                 os.makedirs(path, exist_ok=True)
-                continue
-
-            content = item.get('content', '')
-            write_file_content(path, content)
-            if 'last_modified' in item:
-                os.utime(path, (item['last_modified'], item['last_modified']))
+            else:
+                content = item.get('content', '')
+                write_file_content(path, content)
+                if 'last_modified' in item:
+                    os.utime(path, (item['last_modified'], item['last_modified']))
+            mark_sync_write(written)
+            directory_index.update(path)
     else:
+        removed = [WATCH_PATH]
+        for root, dirs, files in os.walk(WATCH_PATH):
+            removed.extend(os.path.join(root, name) for name in dirs + files)
+        mark_sync_write(removed, pending=True)
         clear_directory_contents(WATCH_PATH)
+        mark_sync_write(removed)
+        directory_index.forget(WATCH_PATH)
+
+def push_pending(peer):
+    """
+    Pushes queued changes to `peer` in order. Entries are dropped from the
+    queue as they are accepted, so a failure only retries what is left.
+    """
+    with push_lock:
+        return _push_pending(peer)
+
+def _push_pending(peer):
+    pending_changes.compact()
+    pushed = 0
+    success = True
+    for entry in pending_changes.snapshot():
+        change = {k: v for k, v in entry.items() if k != "blob"}
+        if "blob" in entry:
+            content = pending_changes.load_content(entry["blob"])
+            if content is None:
+                log(f"Missing blob for {entry['src']}, skipping")
+                pushed += 1
+                continue
+            change["content"] = content
+        try:
+            r = requests.post(f"http://{peer}:5000/push_change", json=change, timeout=30)
+            if r.status_code != 200:
+                log(f"Push to {peer} failed with status {r.status_code}")
+                success = False
+                break
+        except Exception as e:
+            log(f"Push to {peer} failed: {e}")
+            success = False
+            break
+        pushed += 1
+    if pushed:
+        pending_changes.discard(pushed)
+    return success
+
+def reconcile_with_peer(peer, data):
+    """
+    Pushes local pending changes before applying the peer's state, so offline
+    edits are not overwritten. If the push fails the remote state is skipped.
+    """
+    if len(pending_changes):
+        log(f"Pushing {len(pending_changes)} pending change(s) to {peer} before pulling")
+        if not push_pending(peer):
+            log("Pending changes not fully pushed. Keeping local state.")
+            return False
+        try:
+            r = requests.get(f"http://{peer}:5000/get_full_state", timeout=10)
+            if r.status_code != 200:
+                return False
+            data = r.json()
+        except Exception as e:
+            log(f"Peer {peer} unreachable after push: {e}")
+            return False
+    apply_remote_state(data)
+    return True
 
 def initial_sync():
     global current_peer
     peer, data = get_fastest_peer()
     if peer:
         log("Initial sync from peer")
-        current_peer = peer
-        apply_remote_state(data)
+        # Left unset on failure so retry_peer_discovery tries again
+        if reconcile_with_peer(peer, data):
+            current_peer = peer
     else:
         log("No cloud peer reachable at startup. Running in offline mode.")
 
@@ -127,9 +410,8 @@ def retry_peer_discovery():
         time.sleep(30)
         if current_peer is None:
             peer, data = get_fastest_peer()
-            if peer and data:
+            if peer and data and reconcile_with_peer(peer, data):
                 current_peer = peer
-                apply_remote_state(data)
                 log("Peer became available. State pulled.")
 
 # ========== WATCHDOG ==========
@@ -138,18 +420,28 @@ class UserSyncHandler(FileSystemEventHandler):
     def __init__(self):
         super().__init__()
         self.last = {}
+        # Rescans dispatch from the supervisor thread as well as the observer's
+        self.lock = threading.Lock()
 
     def record_change(self, event_type, src_path, is_dir, dest_path=None):
         rel_src = os.path.relpath(src_path, WORKING_DIR)
         rel_dest = os.path.relpath(dest_path, WORKING_DIR) if dest_path else None
         if rel_src.startswith(os.path.basename(__file__)):
             return
+        if is_sync_echo(src_path):
+            return
 
-        now = datetime.now().timestamp()
         key = (event_type, rel_src, rel_dest)
-        if now - self.last.get(key, 0) < 0.5:
-            return
-        self.last[key] = now
+        with self.lock:
+            now = datetime.now().timestamp()
+            if now - self.last.get(key, 0) < 0.5:
+                return
+            # Re-insert so keys stay in timestamp order and expired ones can be
+            # popped off the front, keeping the table bounded on large trees
+            self.last.pop(key, None)
+            self.last[key] = now
+            while now - next(iter(self.last.values())) >= 0.5:
+                del self.last[next(iter(self.last))]
 
         change = {
             "timestamp": datetime.now().isoformat(),
@@ -161,11 +453,9 @@ class UserSyncHandler(FileSystemEventHandler):
         if dest_path:
             change["dest"] = rel_dest
         if event_type in ["created", "modified"] and not is_dir:
-            content = read_file_content(src_path)
-            if content:
-                change["content"] = content
-
-        pending_changes.append(change)
+            pending_changes.append(change, src_path)
+        else:
+            pending_changes.append(change)
         socketio.emit("change", change)
 
     def on_created(self, event):
@@ -203,7 +493,7 @@ def api_status():
             rel = os.path.relpath(path, WORKING_DIR)
             file_state.append({"path": rel, "is_directory": True, "status": "synced"})
     return jsonify({
-        "pending": pending_changes,
+        "pending": pending_changes.snapshot(),
         "files": file_state,
         "peer_connected": connected
     })
@@ -233,16 +523,17 @@ def api_pull():
     if not best_peer:
         return jsonify({"status": "error", "message": "No reachable peers"}), 502
 
+    # Push pending edits first so the pull doesn't overwrite them
+    if not reconcile_with_peer(best_peer, best_data):
+        return jsonify({"status": "error", "message": f"Pending changes could not be pushed to {best_peer}"}), 502
+
     current_peer = best_peer
-    apply_remote_state(best_data)
     log(f"Pulled from fastest peer: {best_peer}")
     return jsonify({"status": "ok", "message": f"Pulled from {best_peer}"})
 
 @app.route("/api/push", methods=["POST"])
 def api_push():
-    global pending_changes
-
-    if not pending_changes:
+    if not len(pending_changes):
         return jsonify({"status": "ok", "message": "No changes to push"})
 
     best_peer = None
@@ -265,21 +556,7 @@ def api_push():
         return jsonify({"status": "error", "message": "No reachable peers"}), 502
 
     # Push all changes to the fastest peer
-    success = True
-    for change in pending_changes:
-        try:
-            r = requests.post(f"http://{best_peer}:5000/push_change", json=change, timeout=30)
-            if r.status_code != 200:
-                log(f"Push to {best_peer} failed with status {r.status_code}")
-                success = False
-                break
-        except Exception as e:
-            log(f"Push to {best_peer} failed: {e}")
-            success = False
-            break
-
-    if success:
-        pending_changes.clear()
+    if push_pending(best_peer):
         return jsonify({"status": "ok", "message": f"Pushed to {best_peer}"})
     else:
         return jsonify({"status": "error", "message": f"Push to {best_peer} failed"}), 502
@@ -287,6 +564,7 @@ def api_push():
 # ========== MAIN ==========
 
 def start():
+    global pending_changes, directory_index
 
     #webbrowser.open("http://localhost:7000")
 
@@ -298,18 +576,29 @@ def start():
             json.dump([], f)
         log("Created missing change_log.json")
 
+    pending_changes = PendingQueue(PENDING_DIR, BLOB_CACHE_BYTES)
+    directory_index = DirectoryIndex(INDEX_DB, WATCH_PATH, log)
+    handler = UserSyncHandler()
+
+    # Journal edits made while the client was stopped before the initial
+    # sync overwrites them, so they are pushed first. On first run there is
+    # nothing to catch, so seeding is left to the watcher in the background.
+    rescanned = directory_index.seeded
+    if rescanned:
+        directory_index.rescan(handler.dispatch)
+
     initial_sync()
     threading.Thread(target=retry_peer_discovery, daemon=True).start()
 
-    observer = Observer()
-    observer.schedule(UserSyncHandler(), path=WATCH_PATH, recursive=True)
-    observer.start()
+    # Watches are registered in the background; rescans cover what they miss
+    watcher = WatchSupervisor(handler, WATCH_PATH, directory_index, log, rescanned)
+    watcher.start()
 
     try:
         socketio.run(app, host="0.0.0.0", port=7000)
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        watcher.stop()
+    watcher.join()
 
 def collectPeers():
     if len(sys.argv) > 1:    
@@ -324,6 +613,8 @@ def printConfiguration():
     print(f" Working directory: {WORKING_DIR}")
     print(f" Watch path: {WATCH_PATH}")
     print(f" Change log file: {CHANGE_LOG}")
+    print(f" Pending queue: {PENDING_DIR}")
+    print(f" Index file: {INDEX_DB}")
     print(f" Machine ID: {MACHINE_ID}")
     print("---\n")
 